@@ -8,14 +8,20 @@ https://github.com/JohannesBuchner/imagehash/blob/master/find_similar_images.py
 Created: 5:02 PM (EST)
 """
 
-import sys, os, json, sqlite3, pickle, csv
-from collections import namedtuple, defaultdict
+import sys, os, json, sqlite3, pickle, csv, functools, hashlib, itertools, multiprocessing
+from collections import namedtuple, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
-import imagehash, pybktree, Levenshtein
+import numpy as np
+import pywt, pybktree
 
 CWD = os.path.abspath("")  # Current script path.
 XBYTES = 1048576  # MiB to byte.
-Img = namedtuple("Img", ["hash_hex", "directory", "filename"])  # Img class for bktree.
+HASH_VERSION = 1  # Bump whenever hash values change (kernels, decoding); dbs hashed under another version get rebuilt.
+IMG_EXTS = frozenset({"png", "jpg", "jpeg", "bmp", "gif", "svg"})  # Image file extensions, lowercase, without dot.
+Img = namedtuple("Img", ["hash_int", "directory", "filename"])  # Img class for bktree; hash_int is the hash as int.
+_INSERT_CHUNKS = (512, 64, 8, 1)  # Rows per multi-row INSERT statement, largest first; see insertRows().
+_STMT_CACHE = dict()  # (nrows, ncols) -> INSERT statement string.
 
 
 def main():
@@ -25,114 +31,162 @@ def main():
     hashFunc = getHashFunc(method=params["hash_method"], hash_size=params["hash_size"])
 
     #### 2. Database #1: image metadata, including perceptual hash.
+    # Hashing for the db is spread over thread and process pools; see hashImages().
     if params["operation"] == "build":  # Build SQL database.
-        buildDatabase(params, hashFunc)
+        buildDatabase(params)
     elif params["operation"] == "update":  # Update database: refresh it to only include all images in params["img_dirs"].
-        updateDatabase(params, hashFunc)
+        updateDatabase(params)
+    else:  # Other operations only read img.db, so its hashes must already match params.
+        checkHashScheme(params)
 
     #### 3. Database #2: spatial data partitioning tree (BK-tree).
     # At this step img.db has been accessed, so it must exist, and thus we assume it exists.
-    updateBKTree(params, dist_method=params["distance_method"])
+    updateBKTree(params)
 
     #### 4. Reverse image search.
     if params["operation"] == "search":
-        hex2path, hex2found = searchByImages(params, hashFunc, dbname="img", always_tree=True)
-        saveMatches2csv(hex2path, hex2found, params["input_dir"])
+        hash2path, hash2found = searchByImages(params, hashFunc, dbname="img", always_tree=True)
+        saveMatches2csv(hash2path, hash2found, params["input_dir"])
 
 
 # region SQL Functions
 
 
-def buildDatabase(params, hashFunc):
+def buildDatabase(params):
     # This forces rebuild and overwrite existing db.
-    createTable(params["db_dir"])
-    for dir_ in params["img_dirs"]:
-        fpaths = getAllImagePaths(dir_, relative=False)
-        hashHex = [None] * len(fpaths)
-        sizes = [None] * len(fpaths)
-        for i, fpath in enumerate(fpaths):
-            hashObj = hashFunc(getPILImage(fpath))
-            hashHex[i] = str(hashObj)
-            sizes[i] = os.path.getsize(fpath)  # In bytes.
-            # assert len(hashHex[i]) == 16, f"Hex string ({hashHex[i]}) must have length of 16."
-        rows = [(*os.path.split(p), h, s / XBYTES, True) for p, h, s in zip(fpaths, hashHex, sizes)]
-        insertData2Table(rows, params["db_dir"])
+    createTable(params["db_dir"], hash_scheme=hashScheme(params))
+    entries = walkImageDirs(params["img_dirs"])
+    # One pipeline for all directories; results come back as (fpath, hash_int, size in bytes).
+    res = hashImages(entries, method=params["hash_method"], hash_size=params["hash_size"])
+    toBytes = functools.partial(int2Bytes, method=params["hash_method"], hash_size=params["hash_size"])
+    rows = [(*os.path.split(p), toBytes(h), s / XBYTES, True) for p, h, s in res]
+    insertData2Table(rows, params["db_dir"])
     # displayTable(params["db_dir"])
 
 
-def updateDatabase(params, hashFunc, dbname="img", del_absent=True):
+def updateDatabase(params, dbname="img", del_absent=True):
     """
     For images in the existing db, remove ones that no longer exist in params["img_dirs"].
     For images not in the existing db but in params["img_dirs"], add them to db.
     End result: the new db has all images in params["img_dirs"], nothing more, nothing less.
     However, if del_absent=False, then the rows that are absent from params["img_dirs"] are retained.
     """
-    dbname = os.path.join(params["db_dir"], f"{dbname}.db")
-    if not os.path.isfile(dbname):  # db doesn't exist, build one and we are done here.
-        buildDatabase(params, hashFunc)
+    if not os.path.isfile(os.path.join(params["db_dir"], f"{dbname}.db")):  # db doesn't exist, build one and we are done here.
+        buildDatabase(params)
         return
-    # Otherwise db exists, we update it.
-    con = sqlite3.connect(dbname)
-    cur = con.cursor()
-    cur.execute("UPDATE image SET present=FALSE;")
-    for dir_ in params["img_dirs"]:
-        fpaths = getAllImagePaths(dir_, relative=False)
-        for i, fpath in enumerate(fpaths):
+    con = connectDB(params["db_dir"], dbname=dbname)
+    if loadHashScheme(con) != hashScheme(params):  # Existing hashes aren't comparable with new ones; rebuild.
+        con.close()
+        print(f"Rebuilding {dbname}.db because it was hashed with a different scheme.")
+        buildDatabase(params)
+        return
+    # Otherwise db exists, we update it, all in one transaction (with-block commits, or rolls back on error).
+    with con:
+        cur = con.cursor()
+        # Composite key -> present flag of every row, in one query; existence checks below are dict lookups.
+        existing = {(d, f): p for d, f, p in cur.execute("SELECT directory, filename, present FROM image;")}
+        # 1st pass: find images already in db; gather the rest for hashing.
+        # absent is keyed by compKey, so an image reached through overlapping img_dirs is hashed and inserted once.
+        found, absent = set(), dict()
+        for fpath, size in walkImageDirs(params["img_dirs"]):
             compKey = os.path.split(fpath)
-            # Find image in db.
-            res = cur.execute("SELECT directory FROM image WHERE directory=? AND filename=?;", compKey)
-            if res.fetchone():  # Found image in db.
-                cur.execute("UPDATE image SET present=TRUE WHERE directory=? AND filename=?;", compKey)
+            if compKey in existing:  # Found image in db.
+                found.add(compKey)
             else:  # Image is absent from db; insert it.
-                hashObj = hashFunc(getPILImage(fpath))
-                values = (*compKey, str(hashObj), os.path.getsize(fpath) / XBYTES, True)
-                s = ",".join("?" for _ in values)
-                s = f"INSERT INTO image VALUES({s});"
-                cur.execute(s, values)
-
-    if del_absent:  # Delete absent rows.
-        cur.execute("DELETE FROM image WHERE present=FALSE;")
-    con.commit()
+                absent[compKey] = (fpath, size)
+        # Only rows whose present flag changes are written.
+        gone = [k for k in existing if k not in found]
+        cur.executemany("UPDATE image SET present=TRUE WHERE directory=? AND filename=?;", [k for k in found if not existing[k]])
+        if del_absent:  # Delete absent rows.
+            cur.executemany("DELETE FROM image WHERE directory=? AND filename=?;", gone)
+        else:
+            cur.executemany("UPDATE image SET present=FALSE WHERE directory=? AND filename=?;", [k for k in gone if existing[k]])
+        # 2nd pass: hash only the images not in db, in parallel, and insert them.
+        res = hashImages(list(absent.values()), method=params["hash_method"], hash_size=params["hash_size"])
+        toBytes = functools.partial(int2Bytes, method=params["hash_method"], hash_size=params["hash_size"])
+        rows = sorted((*os.path.split(p), toBytes(h), s / XBYTES, True) for p, h, s in res)  # In primary key order.
+        insertRows(cur, rows)
     con.close()
 
 
-def createTable(db_dir, dbname="img"):
+def createTable(db_dir, dbname="img", hash_scheme=None):
     """
     Create image table. Filesize unit is MiB (chosen because we are dealing with normal images).
     MiB is Mebibyte, which is 1048576 bytes, or 1024 Kibibytes (KiB); 'tis binary-based unit. i stands for binary.
+    Also create meta table, recording <hash_scheme> (see hashScheme()) the image hashes are computed with.
     If img.db already exists, delete and create a new one.
     """
-    dbname = os.path.join(db_dir, f"{dbname}.db")
-    if os.path.isfile(dbname):
-        os.remove(dbname)  # Delete existing db file.
+    fname = os.path.join(db_dir, f"{dbname}.db")
+    for f in (fname, f"{fname}-wal", f"{fname}-shm"):
+        if os.path.isfile(f):
+            os.remove(f)  # Delete existing db file (and its WAL files, if left over).
 
-    con = sqlite3.connect(dbname)
-    con.execute(
+    con = connectDB(db_dir, dbname=dbname)
+    con.executescript(
         """
         CREATE TABLE image(
             directory TEXT NOT NULL,  -- Full absolute path of the directory containing the file.
             filename TEXT NOT NULL,  -- File name, extension included.
-            hash_hex TEXT,  -- In hex string.
+            hash_bytes BLOB NOT NULL,  -- Hash as fixed-width big-endian bytes (8 bytes for hash_size=8 dhash); see int2Bytes().
             filesize NUMERIC,  -- In MiB.
             present BOOL,  -- Whether the row is present in params["img_dirs"].
             PRIMARY KEY(directory ASC, filename ASC)
             );
+        CREATE INDEX ix_hash ON image(hash_bytes);  -- For exact hash match search.
+        CREATE TABLE meta(
+            key TEXT PRIMARY KEY,
+            value TEXT
+            );
         """
     )
+    with con:
+        con.execute("INSERT INTO meta VALUES('hash_scheme', ?);", (hash_scheme,))
     con.close()
 
 
+def hashScheme(params):
+    # Everything a stored hash value depends on; hashes from different schemes can't be compared.
+    return f"v{HASH_VERSION}:{params['hash_method']}:{params['hash_size']}"
+
+
+def loadHashScheme(con):
+    # Return the hash scheme recorded in the db of <con>, or None for dbs created before the meta table existed.
+    try:
+        row = con.execute("SELECT value FROM meta WHERE key='hash_scheme';").fetchone()
+    except sqlite3.OperationalError:  # No meta table.
+        return None
+    return row[0] if row else None
+
+
+def checkHashScheme(params, dbname="img"):
+    # Exit if <dbname>.db was hashed with a scheme other than params'; its hashes can't be compared with ours.
+    if not os.path.isfile(os.path.join(params["db_dir"], f"{dbname}.db")):
+        return
+    con = connectDB(params["db_dir"], dbname=dbname)
+    scheme = loadHashScheme(con)
+    con.close()
+    if scheme != hashScheme(params):
+        sys.exit(f"{dbname}.db was hashed with {scheme or 'an older version'}, params say {hashScheme(params)}; run update first.")
+
+
+def _schemeWords(scheme):
+    # Number of uint64 words per hash under <scheme>, as returned by hashScheme().
+    _, method, size = scheme.split(":")
+    return _hashWords(method, int(size))
+
+
 def insertData2Table(rows, db_dir, dbname="img"):
+    # Bulk load. Rows go in primary key order, so the table's B-tree is appended to instead of split at random pages.
     if len(rows) == 0:
         return
-    con = sqlite3.connect(os.path.join(db_dir, f"{dbname}.db"))
+    rows = sorted(rows, key=lambda r: (r[0], r[1]))
+    con = connectDB(db_dir, dbname=dbname, exclusive=True)
+    # Connection-scoped; reverts to default when con closes.
+    con.execute("PRAGMA cache_size=-65536;")  # 64 MiB page cache.
     cur = con.cursor()
 
-    s = ",".join(["?"] * len(rows[0]))
-    s = f"INSERT INTO image VALUES({s});"
-
     try:
-        cur.executemany(s, rows)
+        insertRows(cur, rows)
     except:
         raise Exception
 
@@ -140,8 +194,55 @@ def insertData2Table(rows, db_dir, dbname="img"):
     con.close()
 
 
-def displayTable(db_dir, dbname="img"):
+def _insertStmt(nrows, ncols):
+    # Multi-row INSERT with nrows rows of ncols placeholders; built once per shape.
+    key = (nrows, ncols)
+    if key not in _STMT_CACHE:
+        row = "(" + ",".join("?" * ncols) + ")"
+        _STMT_CACHE[key] = f"INSERT INTO image VALUES{','.join([row] * nrows)};"
+    return _STMT_CACHE[key]
+
+
+def insertRows(cur, rows):
+    """Insert rows into image table with one multi-row INSERT per chunk instead of one statement step per row.
+    len(rows) is split greedily into chunks of _INSERT_CHUNKS sizes, so only a handful of distinct statements exist;
+    sqlite3 keeps them compiled in its per-connection statement cache.
+    Chunks that would exceed SQLite's bound-parameter limit are skipped; executemany() covers whatever is left.
+    """
+    if len(rows) == 0:
+        return
+    ncols = len(rows[0])
+    getlimit = getattr(cur.connection, "getlimit", None)  # Python 3.11+.
+    limit = getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if getlimit else 999  # 999 is the oldest SQLite default.
+    i = 0
+    for c in _INSERT_CHUNKS:
+        if c * ncols > limit:
+            continue
+        stmt = _insertStmt(c, ncols)
+        while len(rows) - i >= c:
+            cur.execute(stmt, [v for r in rows[i : i + c] for v in r])
+            i += c
+    if i < len(rows):
+        cur.executemany(_insertStmt(1, ncols), rows[i:])
+
+
+def connectDB(db_dir, dbname="img", exclusive=False):
+    """Open <dbname>.db with write-ahead logging.
+    WAL + synchronous=NORMAL only fsyncs on checkpoints instead of on every commit, and is still corruption-safe.
+    If exclusive=True, the connection locks the db once for its whole lifetime (for bulk loads).
+    That is set before the WAL is first accessed, so SQLite also skips the WAL's shared-memory file.
+    """
     con = sqlite3.connect(os.path.join(db_dir, f"{dbname}.db"))
+    if exclusive:
+        con.execute("PRAGMA locking_mode=EXCLUSIVE;")
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    return con
+
+
+def displayTable(db_dir, dbname="img"):
+    con = connectDB(db_dir, dbname=dbname)
     cur = con.cursor()
     res = cur.execute("SELECT * FROM image")
     res = res.fetchall()  # List.
@@ -158,56 +259,149 @@ def displayTable(db_dir, dbname="img"):
 # region Tree and Distance Functions.
 
 
-def buildBKTree(params, dbname="img", dist_method="hamming"):
-    con = sqlite3.connect(os.path.join(params["db_dir"], f"{dbname}.db"))
-    cur = con.cursor()
-    res = cur.execute("SELECT hash_hex, directory, filename FROM image")
-    imgs = map(Img._make, res.fetchall())
-    con.commit()
-    con.close()
-
-    bk_tree = pybktree.BKTree(getStrDistFunc(method=dist_method), imgs)
-    savePKL(params["bk_dir"], "bk_tree", bk_tree)
+def buildBKTree(params, dbname="img"):
+    # Serialize the hashes in img.db as a flat array; the tree itself is built in memory on load, see loadBKTree().
+    saveIndex(params["bk_dir"], *_readIndex(params, dbname=dbname))
+    fname = os.path.join(params["bk_dir"], "bk_tree.pkl")
+    if os.path.isfile(fname):
+        os.remove(fname)  # Pickled BKTree left over from older versions; no longer used.
 
 
-def updateBKTree(params, dbname="img", dist_method="hamming"):
+def updateBKTree(params, dbname="img"):
     """
-    1) If bk_tree.pkl doesn't exist, then build it.
-    2) If bk_tree.pkl exists, load and then compare with img.db to make sure it has exactly every image in db. If not, then rebuild it.
+    1) If bk_tree.npy doesn't exist, then build it.
+    2) If bk_tree.npy exists and bk_tree.digest matches img.db, it's up to date; done without loading it.
+    3) Otherwise load and then compare with img.db to make sure it has exactly every image in db. If not:
+        a) If images were only added, and fewer than 20% of the existing ones, append them to bk_tree.npy.
+        b) Otherwise rebuild it.
 
     """
-    if not os.path.isfile(os.path.join(params["bk_dir"], "bk_tree.pkl")):  # bk_tree doesn't exist, build it and done.
-        print("Building bk-tree because bk_tree.pkl doesn't exist.")
-        buildBKTree(params, dbname=dbname, dist_method=dist_method)
+    if not indexExists(params["bk_dir"]):  # bk_tree doesn't exist, build it and done.
+        print("Building bk-tree because bk_tree.npy doesn't exist.")
+        buildBKTree(params, dbname=dbname)
         print("Done building.")
         return
 
+    # Digest of db vs the one saved with bk_tree.npy; same digest means nothing changed.
+    digest = _dbDigest(params, dbname=dbname)
+    if digest == loadDigest(params["bk_dir"]):
+        return
+
     # Get images (set of 3-namedtuple) from bk.
-    imgs_bk = set(loadPKL(params["bk_dir"], "bk_tree"))
+    hashes, paths = loadIndex(params["bk_dir"])
+    imgs_bk = {Img(h, *p) for h, p in zip(_iterInts(hashes), paths)}
 
     # Get images (set of 3-namedtuple; even 3-tuple set check would work) from db.
-    con = sqlite3.connect(os.path.join(params["db_dir"], f"{dbname}.db"))
+    imgs_db = {Img(int.from_bytes(h, "big"), d, f) for rows in _iterRows(params, dbname=dbname) for h, d, f in rows}
+
+    # If the two sets are not equal, update or rebuild bk_tree and done.
+    to_add = imgs_db - imgs_bk
+    to_remove = imgs_bk - imgs_db
+    if len(to_remove) == 0 and 0 < len(to_add) < 0.2 * len(imgs_bk):  # Linear in the changes, not in N.
+        print(f"Adding {len(to_add)} images to bk-tree because bk_tree.npy doesn't match {dbname}.db.")
+        hashes = np.concatenate([hashes, _ints2Words([img.hash_int for img in to_add], hashes.shape[1])])
+        paths.extend((img.directory, img.filename) for img in to_add)
+        saveIndex(params["bk_dir"], hashes, paths, digest)
+        print("Done adding.")
+    elif imgs_bk != imgs_db:
+        del hashes  # Drop the memory map before its file is replaced.
+        print(f"Building bk-tree because bk_tree.npy doesn't match {dbname}.db.")
+        buildBKTree(params, dbname=dbname)
+        print("Done building.")
+    else:  # Same images; only the digest is missing or stale.
+        saveDigest(params["bk_dir"], digest)
+
+
+def loadBKTree(params, dist_method="hamming"):
+    """Return a searchable tree of the serialized hashes in params["bk_dir"].
+    If there are fewer than params["flat_index_limit"] images, it is a FlatHashIndex directly over the memory-mapped array;
+    otherwise a BK-tree built in memory. Both have the same find() interface.
+    """
+    hashes, paths = loadIndex(params["bk_dir"])
+    if len(paths) < params["flat_index_limit"]:
+        return FlatHashIndex(hashes, paths)
+    imgs = (Img(h, *p) for h, p in zip(_iterInts(hashes), paths))  # Lazy; the tree takes one Img at a time.
+    return pybktree.BKTree(getStrDistFunc(method=dist_method), imgs)
+
+
+def _iterRows(params, dbname="img", arraysize=10000):
+    # Yield lists of up to <arraysize> (hash_bytes, directory, filename) rows of img.db, in primary key order.
+    # Only one chunk is alive at a time, instead of the whole table from fetchall().
+    con = connectDB(params["db_dir"], dbname=dbname)
     cur = con.cursor()
-    res = cur.execute("SELECT hash_hex, directory, filename FROM image")
-    imgs_db = set(map(Img._make, res.fetchall()))
-    con.commit()
+    cur.arraysize = arraysize
+    cur.execute("SELECT hash_bytes, directory, filename FROM image ORDER BY directory, filename")
+    try:
+        while rows := cur.fetchmany():
+            yield rows
+    finally:
+        con.close()
+
+
+def _digestRows(h, rows):
+    # Feed _iterRows() output into hashlib object <h>.
+    for hash_bytes, d, f in rows:  # hash_bytes is fixed-width, so no separator needed after it.
+        h.update(hash_bytes)
+        h.update(f"{d}\0{f}\n".encode("utf-8", "surrogateescape"))
+
+
+def _dbDigest(params, dbname="img"):
+    # blake2b of img.db's rows; changes if any image is added, removed, renamed, or rehashed.
+    h = hashlib.blake2b(digest_size=32)
+    for rows in _iterRows(params, dbname=dbname):
+        _digestRows(h, rows)
+    return h.digest()
+
+
+def _readIndex(params, dbname="img"):
+    """Return img.db as hashes ((N, words) uint64 array), list of (directory, filename) aligned with it, and its digest.
+    Rows are streamed chunk by chunk into the preallocated array, so peak memory is about that of the result.
+    """
+    con = connectDB(params["db_dir"], dbname=dbname)
+    (n,) = con.execute("SELECT COUNT(*) FROM image").fetchone()
+    scheme = loadHashScheme(con)  # Width follows what img.db was hashed with, not what params currently say.
     con.close()
+    words = _schemeWords(scheme) if scheme else _hashWords(params["hash_method"], params["hash_size"])
+    hashes = np.empty((n, words), dtype=np.uint64)
+    paths = list()
+    h = hashlib.blake2b(digest_size=32)
+    for rows in _iterRows(params, dbname=dbname):
+        hashes[len(paths) : len(paths) + len(rows)] = _ints2Words([int.from_bytes(r[0], "big") for r in rows], words)
+        paths.extend((d, f) for _, d, f in rows)
+        _digestRows(h, rows)
+    return hashes, paths, h.digest()
+
+
+class FlatHashIndex:
+    """Brute-force alternative to the BK-tree; every hash lives in one contiguous (N, words) uint64 array.
+    A query is a single vectorised XOR + popcount over the array: sequential and SIMD friendly,
+    so it beats the BK-tree's pointer chasing for small thresholds and N up to a few million.
+    find() has the same signature and return format as pybktree.BKTree.find().
+    """
 
-    # If the two sets are not equal, rebuild bk_tree and done.
-    if imgs_bk != imgs_db:
-        print(f"Building bk-tree because bk_tree.pkl doesn't match {dbname}.db.")
-        buildBKTree(params, dbname=dbname, dist_method=dist_method)
-        print("Done building.")
+    def __init__(self, hashes, paths):
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint64)  # Shape (N, words).
+        self.paths = paths  # List of (directory, filename), aligned with self.hashes.
+
+    def __len__(self):
+        return len(self.paths)
 
+    def find(self, item, n):
+        # Return a sorted list of len-2 tuple: distance and Img class.
+        dists = _makeScan(self.hashes.shape[1])(self.hashes, _int2Words(item.hash_int, self.hashes.shape[1]))
+        idx = np.nonzero(dists <= n)[0]
+        idx = idx[np.argsort(dists[idx], kind="stable")]
+        return [(int(dists[i]), Img(_words2Int(self.hashes[i]), *self.paths[i])) for i in idx]
 
-def add2BKTree(bk_tree, hash_hex, directory, filename):
-    bk_tree.add(Img(hash_hex, directory, filename))
 
+def add2BKTree(bk_tree, hash_int, directory, filename):
+    bk_tree.add(Img(hash_int, directory, filename))
 
-def findInBKTree(bk_tree, hash_hex, directory=None, filename=None, dist_thres=1):
+
+def findInBKTree(bk_tree, hash_int, directory=None, filename=None, dist_thres=1):
     # Return a list of len-2 tuple: distance and Img class.
-    # Since find only uses the hash_hex of the item and doesn't store anything, composite key is optional.
-    return bk_tree.find(Img(hash_hex, directory, filename), dist_thres)
+    # Since find only uses the hash_int of the item and doesn't store anything, composite key is optional.
+    return bk_tree.find(Img(hash_int, directory, filename), dist_thres)
 
 
 def searchByImages(params, hashFunc, dbname="img", always_tree=True):
@@ -221,51 +415,51 @@ def searchByImages(params, hashFunc, dbname="img", always_tree=True):
         _type_: _description_
     """
     # Get all images to search.
-    hex2path = defaultdict(list)
-    hex2found = defaultdict(list)
+    hash2path = defaultdict(list)
+    hash2found = defaultdict(list)
     fpaths = getAllImagePaths(params["input_dir"], relative=False)
+    draft_size = getDraftSize(method=params["hash_method"], hash_size=params["hash_size"])
     for fpath in fpaths:
         compKey = os.path.split(fpath)  # Len-2 tuple.
-        hashObj = hashFunc(getPILImage(fpath))
-        hex2path[str(hashObj)].append(compKey)
+        hash_int = hashFunc(getPILImage(fpath, draft_size=draft_size))
+        hash2path[hash_int].append(compKey)
     # Find matching images.
-    hexes = list(hex2path.keys())
+    hash_ints = list(hash2path.keys())
     if params["distance_threshold"] == 0 and not always_tree:  # Exact hash match.
-        # Search db by hash_hex match.
-        dbname = os.path.join(params["db_dir"], f"{dbname}.db")
-        assert os.path.isfile(dbname)
-        con = sqlite3.connect(dbname)
+        # Search db by hash_bytes match; an index lookup on ix_hash per hash.
+        assert os.path.isfile(os.path.join(params["db_dir"], f"{dbname}.db"))
+        con = connectDB(params["db_dir"], dbname=dbname)
         cur = con.cursor()
-        query = ",".join("?" for _ in hexes)
-        query = f"SELECT directory, filename, hash_hex FROM image WHERE hash_hex IN ({query})"
-        res = cur.execute(query, hexes)
-        res = res.fetchall()  # List of directory, filename, hash_hex.
+        query = ",".join("?" for _ in hash_ints)
+        query = f"SELECT directory, filename, hash_bytes FROM image WHERE hash_bytes IN ({query})"
+        res = cur.execute(query, [int2Bytes(h, params["hash_method"], params["hash_size"]) for h in hash_ints])
+        res = res.fetchall()  # List of directory, filename, hash_bytes.
         con.commit()
         con.close()
 
         for d, f, h in res:
-            hex2found[h].append((d, f))
-    else:  # bk-tree search.
-        if not os.path.isfile(os.path.join(params["bk_dir"], "bk_tree.pkl")):
-            print("Building bk-tree because bk_tree.pkl doesn't exist.")
-            buildBKTree(params, dbname=dbname, dist_method=params["distance_method"])
+            hash2found[int.from_bytes(h, "big")].append((d, f))
+    else:  # bk-tree search; small dbs are scanned with FlatHashIndex instead (same find() interface).
+        if not indexExists(params["bk_dir"]):
+            print("Building bk-tree because bk_tree.npy doesn't exist.")
+            buildBKTree(params, dbname=dbname)
             print("Done building.")
-        bk_tree = loadPKL(params["bk_dir"], "bk_tree")
-        for hash_hex in hexes:
-            fs = findInBKTree(bk_tree, hash_hex, dist_thres=params["distance_threshold"])
+        bk_tree = loadBKTree(params, dist_method=params["distance_method"])
+        for hash_int in hash_ints:
+            fs = findInBKTree(bk_tree, hash_int, dist_thres=params["distance_threshold"])
             for _, f in fs:  # 1st item of the tuple is distance; 2nd item is Img (namedtuple).
-                hex2found[hash_hex].append((f.directory, f.filename))
+                hash2found[hash_int].append((f.directory, f.filename))
 
-    return hex2path, hex2found
+    return hash2path, hash2found
 
 
-def saveMatches2csv(hex2path, hex2found, dir_):
+def saveMatches2csv(hash2path, hash2found, dir_):
     with open(os.path.join(dir_, "matches.csv"), "w", encoding="utf-8-sig", newline="") as csvfile:
         spamwriter = csv.writer(csvfile, delimiter=",", quotechar='"')
         spamwriter.writerow(["input_path", "match_path", "match_directory", "match_filename"])
-        for h, paths in hex2path.items():
+        for h, paths in hash2path.items():
             path = " | ".join([os.path.join(*compKey) for compKey in paths])
-            for i, tup in enumerate(hex2found[h]):
+            for i, tup in enumerate(hash2found[h]):
                 if i == 0:
                     spamwriter.writerow([path, os.path.join(*tup), tup[0], tup[1]])
                 else:
@@ -275,6 +469,202 @@ def saveMatches2csv(hex2path, hex2found, dir_):
 # endregion
 
 
+# region Hash Functions
+
+
+def _luma(img, size):
+    # Greyscale then resize, same order and filter as imagehash; returns uint8 array of shape (size[1], size[0]).
+    return np.asarray(img.convert("L").resize(size, Image.LANCZOS), dtype=np.uint8)
+
+
+def _bits2int(bits):
+    # Pack a boolean array (row-major, MSB first) into an int; same bit order as str(imagehash.ImageHash).
+    n = bits.size
+    return int.from_bytes(np.packbits(bits, axis=None).tobytes(), "big") >> (-n % 8)
+
+
+def _bits2ints(bits):
+    # Row-wise _bits2int() of a (B, ...) boolean array; list of B ints.
+    bits = bits.reshape(len(bits), -1)
+    packed = np.packbits(bits, axis=1)
+    if bits.shape[1] == 64:  # hash_size=8: each row is exactly one big-endian uint64.
+        return packed.view(">u8").ravel().tolist()
+    return [int.from_bytes(row.tobytes(), "big") >> (-bits.shape[1] % 8) for row in packed]
+
+
+def _dhashBatch(pixels):
+    # pixels is (B, hash_size, hash_size + 1) uint8 stack of _luma() outputs; one compare + pack for all B images.
+    return _bits2ints(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def _ahashBatch(pixels):
+    # pixels is (B, hash_size, hash_size) uint8 stack of _luma() outputs.
+    return _bits2ints(pixels > pixels.mean(axis=(1, 2), keepdims=True))
+
+
+def _dhash(img, hash_size=8):
+    return _dhashBatch(_luma(img, (hash_size + 1, hash_size))[None])[0]
+
+
+def _ahash(img, hash_size=8):
+    return _ahashBatch(_luma(img, (hash_size, hash_size))[None])[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _dctMatrix(n):
+    # DCT-II basis M[k, i] = cos(pi * k * (2i + 1) / (2n)), float32 so matmuls go to SGEMM.
+    # M @ x is scipy.fftpack.dct(x, axis=0) / 2; no orthonormal scaling, so thresholding matches imagehash.phash.
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi / n * (i + 0.5) * k).astype(np.float32)
+
+
+def _phashBatch(pixels, hash_size=8):
+    # pixels is (B, 4 * hash_size, 4 * hash_size) uint8 stack of _luma() outputs.
+    # 2D DCT as two (broadcast) matmuls with a cached basis instead of two scipy dct calls per image.
+    M = _dctMatrix(pixels.shape[1])
+    dctlowfreq = (M @ pixels.astype(np.float32) @ M.T)[:, :hash_size, :hash_size]
+    med = np.median(dctlowfreq.reshape(len(dctlowfreq), -1), axis=1)
+    return _bits2ints(dctlowfreq > med[:, None, None])
+
+
+def _phash(img, hash_size=8, highfreq_factor=4):
+    img_size = hash_size * highfreq_factor
+    return _phashBatch(_luma(img, (img_size, img_size))[None], hash_size=hash_size)[0]
+
+
+def _whashScale(img_size, hash_size=8):
+    # Side length whash resizes an image of size <img_size> to; it depends on the image, unlike the other methods.
+    return max(2 ** int(np.log2(min(img_size))), hash_size)
+
+
+def _whash(img, hash_size=8, mode="haar", remove_max_haar_ll=True):
+    image_scale = _whashScale(img.size, hash_size)
+    return _whashPixels(_luma(img, (image_scale, image_scale)), hash_size, mode, remove_max_haar_ll)
+
+
+def _whashPixels(pixels, hash_size=8, mode="haar", remove_max_haar_ll=True):
+    # imagehash.whash in float32; imagehash divides by 255. and so runs the DWTs in float64.
+    # pixels is the square uint8 _luma() output, with side length _whashScale().
+    assert hash_size & (hash_size - 1) == 0, "hash_size is not power of 2."
+    ll_max_level = int(np.log2(len(pixels)))
+    level = int(np.log2(hash_size))
+    assert level <= ll_max_level, "hash_size in a wrong range."
+    pixels = pixels.astype(np.float32) / np.float32(255)
+    if remove_max_haar_ll:  # Remove low level frequency LL(max_ll) if @remove_max_haar_ll using haar filter.
+        coeffs = pywt.wavedec2(pixels, "haar", level=ll_max_level)
+        coeffs[0] *= 0
+        pixels = pywt.waverec2(coeffs, "haar")
+    dwt_low = pywt.wavedec2(pixels, mode, level=ll_max_level - level)[0]
+    return _bits2int(dwt_low > np.median(dwt_low))
+
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)  # Popcount lookup table per byte.
+
+
+if hasattr(np, "bitwise_count"):  # NumPy 2.0+; ufunc compiled to the CPU's popcount instruction.
+
+    def _popcount(x):
+        # Elementwise popcount of a contiguous 1D uint64 array.
+        return np.bitwise_count(x)
+
+else:
+
+    def _popcount(x):
+        # Elementwise popcount of a contiguous 1D uint64 array, via the per-byte lookup table.
+        return _POPCOUNT8[x.view(np.uint8)].reshape(len(x), 8).sum(axis=1, dtype=np.uint8)
+
+
+@functools.lru_cache(maxsize=None)
+def _makeScan(hash_words):
+    """Return scan(hashes, needle), the hamming distances (uint32) from <needle> to every row of hashes.
+    hashes is (N, hash_words) uint64 array; needle is (hash_words,) uint64 array, as from _int2Words().
+    One kernel is built per word count, which is fixed by hash_size: the common 1-word (hash_size <= 8) case is
+    a single XOR + popcount pass, and wider hashes accumulate one such pass per word column into one output array,
+    instead of popcounting a full (N, hash_words * 8) byte array and then reducing it.
+    """
+    if hash_words == 1:
+
+        def scan(hashes, needle):
+            return _popcount(hashes[:, 0] ^ needle[0]).astype(np.uint32)
+
+    else:
+
+        def scan(hashes, needle):
+            dists = np.zeros(len(hashes), dtype=np.uint32)
+            for w in range(hash_words):
+                dists += _popcount(hashes[:, w] ^ needle[w])
+            return dists
+
+    return scan
+
+
+@functools.lru_cache(maxsize=None)
+def hashBits(method="dhash", hash_size=8):
+    """Return the max number of bits in a <method> hash, i.e., the width hashes are stored and indexed at.
+    It's hash_size**2 for every method but whash-db4: db4's 8-tap filter pads each DWT level, so its low-pass band
+    is wider than hash_size (14x14 for hash_size=8), and how much wider depends on the image's whash scale.
+    """
+    if method != "whash-db4":
+        return hash_size * hash_size
+    filter_len = pywt.Wavelet("db4").dec_len
+    side = hash_size
+    for level in range(1, 25):  # Whash scales up to hash_size * 2**24; the side levels off after a few levels.
+        n = hash_size * 2**level
+        for _ in range(level):
+            n = pywt.dwt_coeff_len(n, filter_len, "symmetric")  # Same mode as pywt.wavedec2() default.
+        side = max(side, n)
+    return side * side
+
+
+def _hashWords(method="dhash", hash_size=8):
+    # Number of uint64 words needed to hold a <method> hash; see hashBits().
+    return -(-hashBits(method, hash_size) // 64)
+
+
+def _int2Words(hash_int, words):
+    # Split a hash into uint64 words, most significant first.
+    assert hash_int.bit_length() <= 64 * words, f"Hash has {hash_int.bit_length()} bits; more than {words} words."
+    return np.array([(hash_int >> (64 * i)) & 0xFFFFFFFFFFFFFFFF for i in reversed(range(words))], dtype=np.uint64)
+
+
+def _words2Int(row):
+    # Inverse of _int2Words().
+    return int.from_bytes(row.astype(">u8").tobytes(), "big")
+
+
+def _ints2Words(hash_ints, words):
+    # (N, words) uint64 array of hashes, each split as in _int2Words().
+    nbits = max((h.bit_length() for h in hash_ints), default=0)
+    assert nbits <= 64 * words, f"Hash has {nbits} bits; more than {words} words."
+    hashes = np.empty((len(hash_ints), words), dtype=np.uint64)
+    for j in range(words):
+        shift = 64 * (words - 1 - j)
+        hashes[:, j] = [(h >> shift) & 0xFFFFFFFFFFFFFFFF for h in hash_ints]
+    return hashes
+
+
+def _words2Ints(hashes):
+    # Inverse of _ints2Words(); list of int.
+    if hashes.shape[1] == 1:
+        return hashes[:, 0].tolist()
+    return [_words2Int(row) for row in hashes]
+
+
+def _iterInts(hashes, chunk=10000):
+    # Lazy _words2Ints(), <chunk> rows at a time.
+    for i in range(0, len(hashes), chunk):
+        yield from _words2Ints(hashes[i : i + chunk])
+
+
+def int2Bytes(hash_int, method="dhash", hash_size=8):
+    # Fixed-width big-endian bytes of a <method> hash, as stored in img.db; int.from_bytes(b, "big") is the inverse.
+    return hash_int.to_bytes(-(-hashBits(method, hash_size) // 8), "big")
+
+
+# endregion
+
+
 # region Helper Functions
 
 
@@ -282,46 +672,46 @@ def getParams():
     tmp = CWD
     tmp = os.path.join(CWD, "tmp")  # Remove this line for release ver.
     fpath = os.path.join(tmp, "params.json")
+    params = dict()
+    params["db_dir"] = tmp
+    params["img_dirs"] = [tmp]
+    params["bk_dir"] = tmp
+    params["input_dir"] = os.path.join(tmp, "input")
+    params["operation"] = "update"
+    params["hash_method"] = "dhash"
+    params["hash_size"] = 8  # Same default as in imagehash.
+    params["distance_method"] = "hamming"
+    params["distance_threshold"] = 0
+    params["flat_index_limit"] = 1000000  # Below this many images, search scans a FlatHashIndex instead of the bk-tree.
     if os.path.isfile(fpath):
         with open(fpath) as f:
-            params = json.load(f)
+            params.update(json.load(f))  # Keys missing from an older params.json keep their defaults.
     else:
-        params = dict()
-        params["db_dir"] = tmp
-        params["img_dirs"] = [tmp]
-        params["bk_dir"] = tmp
-        params["input_dir"] = os.path.join(tmp, "input")
-        params["operation"] = "update"
-        params["hash_method"] = "dhash"
-        params["hash_size"] = 8  # Same default as in imagehash.
-        params["distance_method"] = "hamming"
-        params["distance_threshold"] = 0
         with open(fpath, "w") as f:
             json.dump(params, f, indent=4)
     return params
 
 
 def getHashFunc(method="dhash", hash_size=8):
-    """Return hashing function from imagehash.
-    imagehash functions handle greyscaling and resizing, so we don't do them here.
+    """Return hashing function.
+    All methods use our own float32/uint8 NumPy kernels (see Hash Functions region), ported from imagehash.
+    Greyscaling and resizing are handled inside, so we don't do them here.
     The returned function <hashFunc> only takes PIL.Image.Image instance.
-    <hashFunc> returns imagehash.ImageHash object, which .
+    <hashFunc> returns the hash as int, laid out like imagehash.ImageHash, i.e., int(str(ImageHash), 16).
     """
     if method == "ahash":
-        hashfunc = imagehash.average_hash
+        hashfunc = _ahash
     elif method == "phash":
-        hashfunc = imagehash.phash
+        hashfunc = _phash
     elif method == "dhash":
-        hashfunc = imagehash.dhash
+        hashfunc = _dhash
     elif method == "whash-haar":
-        hashfunc = imagehash.whash
+        hashfunc = _whash
     elif method == "whash-db4":
-
-        def hashfunc(img, **kwargs):
-            return imagehash.whash(img, mode="db4", **kwargs)
+        hashfunc = functools.partial(_whash, mode="db4")
 
     else:  # Default to dhash if method is undefined.
-        hashfunc = imagehash.dhash
+        hashfunc = _dhash
 
     # Below 2 methods are different from above and don't have hash_size param.
     # elif method == "colorhash":
@@ -329,18 +719,88 @@ def getHashFunc(method="dhash", hash_size=8):
     # elif method == "crop-resistant":
     #     hashfunc = imagehash.crop_resistant_hash
 
-    def hashFunc(img):
-        return hashfunc(img, hash_size=hash_size)
+    # partial, not a closure: hash_size is bound once instead of building kwargs on every call.
+    return functools.partial(hashfunc, hash_size=hash_size)
+
 
-    return hashFunc
+def _prepareImage(fpath, method="dhash", hash_size=8):
+    # Decode <fpath> to the greyscale pixels <method>'s kernel takes; see _hashPixels().
+    draft_size = getDraftSize(method=method, hash_size=hash_size)
+    img = getPILImage(fpath, draft_size=draft_size)
+    if draft_size is None:  # whash.
+        image_scale = _whashScale(img.size, hash_size)
+        return _luma(img, (image_scale, image_scale))
+    return _luma(img, draft_size)  # For the other methods the draft size is exactly their resize target.
 
 
-def _hamming(str1, str2):
-    return Levenshtein.hamming(str1.hash_hex, str2.hash_hex, pad=True)
+def _hashPixels(method, hash_size, pixels):
+    # Hash a list of _prepareImage() outputs; list of int. Batch kernels take them all in one NumPy call.
+    if method == "ahash":
+        return _ahashBatch(np.stack(pixels))
+    elif method == "phash":
+        return _phashBatch(np.stack(pixels), hash_size=hash_size)
+    elif method == "whash-haar":
+        return [_whashPixels(p, hash_size) for p in pixels]
+    elif method == "whash-db4":
+        return [_whashPixels(p, hash_size, mode="db4") for p in pixels]
+    else:  # dhash, also the default in getHashFunc().
+        return _dhashBatch(np.stack(pixels))
+
+
+def _boundedMap(executor, fn, iterable, maxsize):
+    # Lazy, ordered executor.map() with at most <maxsize> tasks in flight, so a stage never runs far ahead of the next.
+    pending = deque()
+    for item in iterable:
+        if len(pending) == maxsize:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batched(iterable, n):
+    # Lists of <n> consecutive items (the last may be shorter).
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def hashImages(entries, method="dhash", hash_size=8, batch_size=256, queue_size=256):
+    """Hash images with a 2-stage pipeline:
+    1) A thread pool opens, draft-decodes, and resizes images into small greyscale arrays.
+       This is I/O plus libjpeg/Pillow work that releases the GIL, so threads overlap disk reads without extra processes.
+    2) A process pool (one worker per CPU core) hashes batches of <batch_size> arrays, one NumPy call per batch.
+       whash arrays are image-sized (up to thousands of pixels a side) and hashed per image, so they go one per task.
+    Each stage has at most <queue_size> tasks in flight, which bounds memory;
+    for whash that is two per CPU core instead, since each array can be megabytes.
+    Hash workers are started by a fork server (or spawned, where there is none), never forked from this process,
+    because forking while decoder threads hold locks can deadlock the children.
+    <entries> is a list of (fpath, size in bytes), as from walkImageDirs().
+    Returns a list of (fpath, hash_int, size in bytes), in the same order as <entries>.
+    """
+    if len(entries) == 0:
+        return []
+    if method.startswith("whash"):
+        batch_size = 1
+        queue_size = 2 * (os.cpu_count() or 1)
+    prepare = functools.partial(_prepareImage, method=method, hash_size=hash_size)
+    kernel = functools.partial(_hashPixels, method, hash_size)
+    mp_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    with ThreadPoolExecutor() as decoders, ProcessPoolExecutor(mp_context=mp_context) as hashers:
+        pixels = _boundedMap(decoders, prepare, (fpath for fpath, _ in entries), queue_size)
+        hash_ints = _boundedMap(hashers, kernel, _batched(pixels, batch_size), queue_size)
+        hash_ints = itertools.chain.from_iterable(hash_ints)
+        return [(fpath, h, size) for (fpath, size), h in zip(entries, hash_ints)]
+
+
+def _hamming(img1, img2):
+    # XOR + popcount on the parsed hashes; works for any hash_size since Python ints are arbitrary width.
+    # pybktree calls this for every node visited, so index Img (a tuple; [0] is hash_int) instead of attribute lookup.
+    return (img1[0] ^ img2[0]).bit_count()
 
 
 def getStrDistFunc(method="hamming"):
-    # Calculate distance between 2 strings (accessed via Img.hash_hex (namedtuple attribute)).
+    # Calculate distance between 2 hashes (accessed via Img.hash_int (namedtuple attribute)).
     if method == "hamming":
         return _hamming
     else:
@@ -348,48 +808,72 @@ def getStrDistFunc(method="hamming"):
 
 
 def isImage(fname):
-    f = fname.lower()
-    return (
-        f.endswith(".png")
-        or f.endswith(".jpg")
-        or f.endswith(".jpeg")
-        or f.endswith(".bmp")
-        or f.endswith(".gif")
-        or ".jpg" in f
-        or f.endswith(".svg")
-    )
+    # One set lookup on the lowercased extension.
+    i = fname.rfind(".")
+    return i >= 0 and fname[i + 1 :].lower() in IMG_EXTS
+
+
+def getDraftSize(method="dhash", hash_size=8):
+    # Smallest (width, height) hashFunc resizes to, or None if that depends on the image (whash).
+    if method == "ahash":
+        return hash_size, hash_size
+    elif method == "phash":
+        return 4 * hash_size, 4 * hash_size
+    elif method.startswith("whash"):
+        return None
+    else:  # dhash, also the default in getHashFunc().
+        return hash_size + 1, hash_size
 
 
-def getPILImage(fname):
+def getPILImage(fname, draft_size=None):
     # Assume fname is a path to a valid image.
     # Comment out below if we don't make this assumption.
     # if not isImage(fname):
     #     return None
-    return Image.open(fname)
+    img = Image.open(fname)
+    if draft_size is not None and img.format == "JPEG":
+        # libjpeg decodes straight to greyscale at 1/2, 1/4, or 1/8 scale, the smallest no smaller than draft_size.
+        img.draft("L", draft_size)
+    return img
+
+
+def _walkImages(top_dir):
+    # Recursive os.scandir() walk yielding os.DirEntry of every image; same rules as os.walk(),
+    # i.e., symlinked dirs aren't followed and unreadable dirs are skipped.
+    # DirEntry.path is joined in C, and DirEntry.name is checked before any path is built.
+    try:
+        it = os.scandir(top_dir)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from _walkImages(entry.path)
+            elif isImage(entry.name):
+                yield entry
 
 
 def getAllImagePaths(top_dir, relative=True):
-    # Default is top-down, and dirs and files are folders and files in the root dir.
-    # Just need to iterate over all files, since os.walk goes through all dir and subdir.
-    fnames = list()
+    # Walk top_dir and all its subdirs for image files.
+    fnames = [entry.path for entry in _walkImages(top_dir)]
     if relative:
         prefix_len = len(top_dir)
-        for root, dirs, files in os.walk(top_dir):
-            for file in files:
-                if isImage(file):
-                    fnames.append(os.path.join(root, file)[prefix_len:])
-    else:
-        for root, dirs, files in os.walk(top_dir):
-            for file in files:
-                if isImage(file):
-                    fnames.append(os.path.join(root, file))
+        fnames = [f[prefix_len:] for f in fnames]
 
     return fnames
 
 
-def savePKL(dir_out, fname, file):
-    with open(os.path.join(dir_out, f"{fname}.pkl"), "wb") as f:
-        pickle.dump(file, f)
+def walkImageDirs(dirs):
+    # getAllImageEntries() of several dirs, walked concurrently on threads (stat and readdir are syscalls); one flat list.
+    with ThreadPoolExecutor() as walkers:
+        return [entry for entries in walkers.map(getAllImageEntries, dirs) for entry in entries]
+
+
+def getAllImageEntries(top_dir):
+    # Like getAllImagePaths(top_dir, relative=False), but list of (fpath, size in bytes).
+    # Size comes from the DirEntry's stat, taken during the walk, instead of a separate os.path.getsize() later.
+    return [(entry.path, entry.stat().st_size) for entry in _walkImages(top_dir)]
 
 
 def loadPKL(dir_in, fname):
@@ -398,8 +882,53 @@ def loadPKL(dir_in, fname):
     return file
 
 
+def saveIndex(dir_out, hashes, paths, digest):
+    # Hashes go to bk_tree.npy as a raw (N, words) uint64 array; (directory, filename) list goes to bk_tree_paths.pkl.
+    # Each file is written to a temp file first and then swapped in, so a crash never leaves a half-written file.
+    # The digest of the db they came from is removed first and written last, so it only exists for a complete index.
+    fname = os.path.join(dir_out, "bk_tree.digest")
+    if os.path.isfile(fname):
+        os.remove(fname)
+    fname = os.path.join(dir_out, "bk_tree.npy")
+    with open(f"{fname}.tmp", "wb") as f:
+        np.save(f, hashes)
+    os.replace(f"{fname}.tmp", fname)
+    fname = os.path.join(dir_out, "bk_tree_paths.pkl")
+    with open(f"{fname}.tmp", "wb") as f:
+        pickle.dump(paths, f)
+    os.replace(f"{fname}.tmp", fname)
+    saveDigest(dir_out, digest)
+
+
+def saveDigest(dir_out, digest):
+    fname = os.path.join(dir_out, "bk_tree.digest")
+    with open(f"{fname}.tmp", "wb") as f:
+        f.write(digest)
+    os.replace(f"{fname}.tmp", fname)
+
+
+def loadDigest(dir_in):
+    # Return the digest saved with bk_tree.npy, or None if there is none.
+    fname = os.path.join(dir_in, "bk_tree.digest")
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+def loadIndex(dir_in):
+    # Hashes are memory-mapped (zero-copy, and shared via page cache across runs) instead of unpickled.
+    hashes = np.load(os.path.join(dir_in, "bk_tree.npy"), mmap_mode="r")
+    return hashes, loadPKL(dir_in, "bk_tree_paths")
+
+
+def indexExists(dir_):
+    return os.path.isfile(os.path.join(dir_, "bk_tree.npy")) and os.path.isfile(os.path.join(dir_, "bk_tree_paths.pkl"))
+
+
 # endregion
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Must come first; lets pool workers start inside a frozen (built) executable.
     main()